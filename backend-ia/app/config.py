@@ -12,12 +12,40 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+# JWT secret del proyecto (Settings > API). Opcional: si no está configurado,
+# los tokens se verifican siempre contra Supabase Auth.
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+
+# Pool HTTP hacia Supabase (por proceso/worker): conexiones totales y keep-alive
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "100"))
+SUPABASE_MAX_KEEPALIVE = int(os.getenv("SUPABASE_MAX_KEEPALIVE", "50"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+
+# Modo debug: incluye trazas completas en los logs de error
+DEBUG = os.getenv("DEBUG", "false").lower() in ("1", "true", "yes")
 
 # Storage bucket name
 STORAGE_BUCKET = "urine-images"
 
+# Verificar en la tabla images que storage_path existe antes de firmar una URL.
+# En producción la ruta ({doctor_id}/...) y las policies del bucket ya garantizan
+# la propiedad, así que se omite (una consulta menos por URL). Activarlo en
+# entornos donde las policies de Storage no cubran todos los buckets.
+VALIDATE_IMAGE_IN_DB = os.getenv("VALIDATE_IMAGE_IN_DB", "false").lower() in ("1", "true", "yes")
+
 # Model path
-MODEL_PATH = "app/model/best.pt"
+# Si existe el export ONNX (scripts/export_onnx.py) se usa ese: Ultralytics lo
+# ejecuta con ONNX Runtime manteniendo el mismo pre/post-procesado.
+MODEL_PATH_PT = "app/model/best.pt"
+MODEL_PATH_ONNX = "app/model/best.onnx"
+MODEL_PATH = os.getenv("MODEL_PATH") or (
+    MODEL_PATH_ONNX if os.path.exists(MODEL_PATH_ONNX) else MODEL_PATH_PT
+)
+MODEL_NAME = os.path.basename(MODEL_PATH)
+
+# Inferencias YOLO simultáneas (1 con una sola GPU; ~núcleos disponibles en CPU).
+# Se carga una instancia del modelo por inferencia simultánea (más memoria por worker).
+YOLO_WORKERS = int(os.getenv("YOLO_WORKERS", "2"))
 
 # Validar que las variables críticas estén configuradas
 if not SUPABASE_URL:
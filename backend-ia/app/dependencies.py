@@ -2,38 +2,142 @@
 Dependencias de FastAPI para autenticación y clientes Supabase.
 Este módulo evita importaciones circulares.
 """
-from fastapi import HTTPException, Depends
+import time
+
+import httpx
+from cachetools import TTLCache
+from fastapi import HTTPException, Depends, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from jose import jwt, JWTError
 from supabase import create_client, Client
-from app.config import SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, SUPABASE_ANON_KEY
+from app.config import (
+    SUPABASE_URL,
+    SUPABASE_SERVICE_ROLE_KEY,
+    SUPABASE_ANON_KEY,
+    SUPABASE_JWT_SECRET,
+    SUPABASE_MAX_CONNECTIONS,
+    SUPABASE_MAX_KEEPALIVE,
+    SUPABASE_KEEPALIVE_EXPIRY,
+)
+
+# Pool de conexiones compartido (keep-alive + HTTP/2) para las llamadas a Supabase.
+# Es por worker: con N workers el total hacia Supabase es N * SUPABASE_MAX_CONNECTIONS.
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+    max_connections=SUPABASE_MAX_CONNECTIONS,
+    keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+)
+_shared_transport = httpx.HTTPTransport(http2=True, limits=HTTP_LIMITS)
+
+def _use_shared_transport(client: Client) -> None:
+    """
+    Sustituye el transporte de los httpx.Client internos de PostgREST y Storage
+    por el pool compartido, conservando su base_url y headers.
+    Se accede a atributos internos de supabase-py, por eso cada paso es opcional.
+    No se usa ClientOptions(httpx_client=...): postgrest y storage reasignan
+    base_url y headers sobre el cliente recibido, y compartirlo los pisaría.
+    """
+    for get_session in (lambda: client.postgrest.session, lambda: client.storage._client):
+        try:
+            session = get_session()
+            old_transport = session._transport
+            session._transport = _shared_transport
+            old_transport.close()
+        except AttributeError:
+            pass
 
 # Cliente Supabase con service_role_key para operaciones administrativas
 supabase_admin: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-
-# Cliente Supabase con anon_key para verificar tokens de usuarios
-supabase_auth: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+_use_shared_transport(supabase_admin)
 
 # Security scheme para validar tokens JWT
 security = HTTPBearer()
 
+# Cliente HTTP asíncrono compartido para consultar Supabase Auth sin bloquear
+# el event loop. Se cierra en el evento shutdown de la app (ver main.py).
+auth_http_client = httpx.AsyncClient(base_url=SUPABASE_URL, timeout=5.0, http2=True, limits=HTTP_LIMITS)
+
+# Cache de tokens ya verificados: token -> (user_id, exp)
+# El TTL acota cuánto tiempo se confía en un token sin volver a validarlo.
+# Solo se accede desde el event loop, sin awaits intermedios, por lo que no necesita lock.
+_token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
 def get_supabase_client() -> Client:
     """Dependency: retorna el cliente Supabase con service_role para operaciones administrativas."""
     return supabase_admin
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+async def get_storage_bucket(request: Request):
+    """Dependency: retorna el cliente del bucket de Storage creado al arrancar la app (ver main.py)."""
+    return request.app.state.storage
+
+def _decode_token_locally(token: str) -> tuple[str, float]:
+    """
+    Verifica firma, expiración y audiencia del JWT con el secreto del proyecto.
+    Retorna (user_id, exp). Lanza JWTError si el token no es válido.
+    """
+    payload = jwt.decode(
+        token,
+        SUPABASE_JWT_SECRET,
+        algorithms=["HS256"],
+        audience="authenticated",
+    )
+    user_id = payload.get("sub")
+    if not user_id:
+        raise JWTError("Token sin 'sub'")
+    return user_id, float(payload["exp"])
+
+async def _verify_token_remotely(token: str) -> str:
+    """Verifica el token contra Supabase Auth (una llamada de red no bloqueante)."""
+    response = await auth_http_client.get(
+        "/auth/v1/user",
+        headers={"Authorization": f"Bearer {token}", "apikey": SUPABASE_ANON_KEY},
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    user_id = response.json().get("id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    return user_id
+
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
     """
     Verifica el token JWT del frontend y retorna el user_id.
     El frontend envía el access_token de Supabase Auth.
-    Usamos el cliente con anon_key para verificar tokens de usuarios.
+    Si SUPABASE_JWT_SECRET está configurado, el token se valida localmente
+    (firma + exp + aud); solo si eso falla se consulta a Supabase Auth.
+    Los tokens válidos se cachean hasta 60 s (nunca más allá de su exp).
     """
     token = credentials.credentials
-    
+    now = time.time()
+
+    cached = _token_cache.get(token)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    if SUPABASE_JWT_SECRET:
+        try:
+            user_id, exp = _decode_token_locally(token)
+            _token_cache[token] = (user_id, exp)
+            return user_id
+        except (JWTError, KeyError, ValueError):
+            # Puede ser un token firmado con otra clave; dejar que Supabase decida
+            pass
+
     try:
         # Verificar el token con Supabase usando anon_key
         # Esto valida que el token es válido y pertenece a un usuario autenticado
-        response = supabase_auth.auth.get_user(token)
-        if not response.user:
-            raise HTTPException(status_code=401, detail="Token inválido")
-        return response.user.id
+        user_id = await _verify_token_remotely(token)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Error al verificar token: {str(e)}")
+
+    # Nunca cachear más allá del exp del propio token (Supabase ya validó la firma)
+    try:
+        exp = float(jwt.get_unverified_claims(token).get("exp", now))
+    except (JWTError, TypeError, ValueError):
+        exp = now
+    expires_at = min(now + 60, exp)
+    if expires_at > now:
+        _token_cache[token] = (user_id, expires_at)
+    return user_id
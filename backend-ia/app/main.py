@@ -9,18 +9,59 @@ Este backend:
 - Guarda resultados en Supabase Postgres
 - Respeta RLS: solo procesa imágenes del doctor autenticado
 """
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.routes.predict import router as predict_router
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from app.routes.predict import (
+    router as predict_router,
+    start_batch_workers,
+    stop_batch_workers,
+    warmup,
+    is_request_too_large,
+)
 from app.routes.history import router as history_router
 from app.routes.storage import router as storage_router
+from app.dependencies import auth_http_client, supabase_admin
+from app.config import STORAGE_BUCKET
 
 app = FastAPI(
     title="IA Sedimento Urinario API",
     description="API para análisis de sedimento urinario con YOLO",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson serializa mucho más rápido las listas grandes de detections
+    default_response_class=ORJSONResponse
 )
 
+class UploadSizeLimitMiddleware:
+    """
+    Rechaza uploads a /predict demasiado grandes por su Content-Length, antes de
+    que FastAPI lea y parsee el multipart. Middleware ASGI puro: el resto de
+    rutas pasa directo, sin el coste de BaseHTTPMiddleware.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["path"].startswith("/predict"):
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if is_request_too_large(value.decode("latin-1")):
+                        response = ORJSONResponse(
+                            status_code=413,
+                            content={"detail": "Imagen demasiado grande (máximo 10MB)"}
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+# Se registra antes que CORS para que la respuesta 413 también lleve las cabeceras CORS
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # CORS: Permitir requests desde el frontend Next.js
 app.add_middleware(
     CORSMiddleware,
@@ -35,12 +76,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Comprimir respuestas grandes (historial con muchas detections)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 
 # Incluir routers
 app.include_router(predict_router)
 app.include_router(history_router)
 app.include_router(storage_router)
 
+@app.on_event("startup")
+async def create_storage_bucket_client():
+    """Crea una sola vez el cliente del bucket (STORAGE_BUCKET es fijo) y lo comparte entre requests."""
+    app.state.storage = supabase_admin.storage.from_(STORAGE_BUCKET)
+
+@app.on_event("startup")
+async def warm_up_model():
+    """Precalienta el modelo YOLO antes de aceptar peticiones."""
+    await asyncio.to_thread(warmup)
+
+@app.on_event("startup")
+async def start_inference_batching():
+    """Arranca los workers que agrupan las inferencias YOLO en lotes."""
+    start_batch_workers()
+
+@app.on_event("shutdown")
+async def stop_inference_batching():
+    await stop_batch_workers()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    """Cierra el cliente HTTP compartido usado para verificar tokens."""
+    await auth_http_client.aclose()
+
 @app.get("/")
 def root():
     return {
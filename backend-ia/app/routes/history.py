@@ -2,13 +2,100 @@
 Endpoints para consultar historial de análisis.
 Todos los endpoints respetan RLS y solo retornan datos del doctor autenticado.
 """
+import asyncio
+import logging
+import re
 from fastapi import APIRouter, HTTPException, Depends, Query
 from supabase import Client
 from typing import Optional, List
-from app.dependencies import get_supabase_client, verify_token
+from app.dependencies import get_supabase_client, get_storage_bucket, verify_token
 
 router = APIRouter(prefix="/history", tags=["history"])
 
+logger = logging.getLogger(__name__)
+
+# Caracteres reservados en la sintaxis de filtros de PostgREST (or_, ilike)
+_SEARCH_RESERVED = re.compile(r'[%*,()"\\]')
+
+# Validez de las signed URLs incluidas en /history/images
+SIGNED_URL_EXPIRES_IN = 3600
+
+# Select anidado para el detalle de un análisis (imagen -> visita -> caso -> paciente)
+ANALYSIS_DETAIL_SELECT = """
+    *,
+    image:images(
+        id,
+        storage_path,
+        original_filename,
+        content_type,
+        visit_id,
+        created_at,
+        visit:visits(
+            id,
+            visit_date,
+            case:cases(
+                id,
+                title,
+                patient:patients(id, code)
+            )
+        )
+    )
+"""
+
+# Si el embed de PostgREST falla varias veces seguidas por relaciones no
+# configuradas (PGRST200/201), se deja de intentar y se usa directamente la RPC.
+EMBED_OK: bool = True
+EMBED_MAX_FAILURES = 3
+_embed_failures = 0
+
+def _is_embed_error(error: Exception) -> bool:
+    """True si PostgREST no pudo resolver una relación del embed (no un error transitorio)."""
+    return getattr(error, "code", None) in ("PGRST200", "PGRST201")
+
+def _is_not_found(error: Exception) -> bool:
+    """True si PostgREST indica que .single() no encontró filas."""
+    return getattr(error, "code", None) == "PGRST116"
+
+def _sanitize_search(search: str) -> str:
+    """Quita del término los caracteres con significado en filtros PostgREST."""
+    return _SEARCH_RESERVED.sub("", search.strip())
+
+def _filter_patients_by_code_or_alias(supabase: Client, query, doctor_id: str, search_term: str):
+    """
+    Aplica a `query` el filtro código/alias con ilike en el servidor.
+    PostgREST no admite un or_ de nivel superior sobre columnas embebidas,
+    así que los ids con alias coincidente se resuelven en una consulta aparte.
+    """
+    alias_response = supabase.table("patient_details").select("patient_id").eq(
+        "doctor_id", doctor_id
+    ).ilike("alias", f"%{search_term}%").execute()
+    alias_ids = [d["patient_id"] for d in (alias_response.data or []) if d.get("patient_id")]
+
+    if not alias_ids:
+        return query.ilike("code", f"%{search_term}%")
+    return query.or_(f"code.ilike.*{search_term}*,id.in.({','.join(alias_ids)})")
+
+async def _attach_signed_urls(storage_client, images: List[dict]) -> None:
+    """
+    Agrega 'signed_url' a cada imagen con un único create_signed_urls.
+    Si Storage falla, las imágenes se retornan igual con signed_url = None.
+    """
+    paths = [img["storage_path"] for img in images if img.get("storage_path")]
+    signed_by_path = {}
+    if paths:
+        try:
+            # Llamada bloqueante a Storage: en un hilo para no frenar el event loop
+            signed = await asyncio.to_thread(storage_client.create_signed_urls, paths, SIGNED_URL_EXPIRES_IN)
+            for item in signed or []:
+                url = item.get("signedURL") or item.get("signedUrl")
+                if item.get("path") and url:
+                    signed_by_path[item["path"]] = url
+        except Exception as e:
+            logger.warning("No se pudieron generar signed URLs: %s", e)
+    
+    for img in images:
+        img["signed_url"] = signed_by_path.get(img.get("storage_path"))
+
 @router.get("/patients")
 async def list_patients(
     search: Optional[str] = Query(None, description="Buscar por código o alias"),
@@ -20,6 +107,8 @@ async def list_patients(
     Incluye detalles si existen.
     Opcionalmente filtra por código o alias si se proporciona 'search'.
     """
+    search_term = _sanitize_search(search) if search else ""
+
     try:
         # Obtener pacientes con sus detalles
         # Intentar con relación, si falla usar solo patients
@@ -31,13 +120,19 @@ async def list_patients(
                 """
             ).eq("doctor_id", doctor_id)
             
+            # Si hay búsqueda, filtrar por código o alias en la BD
+            if search_term:
+                query = _filter_patients_by_code_or_alias(supabase, query, doctor_id, search_term)
+            
             response = query.order("code").execute()
             patients = response.data or []
         except Exception as rel_error:
             # Si falla la relación (tabla no existe o error de relación), usar solo patients
-            print(f"Warning: No se pudo cargar patient_details: {rel_error}")
+            logger.warning("No se pudo cargar patient_details: %s", rel_error)
             try:
                 query = supabase.table("patients").select("*").eq("doctor_id", doctor_id)
+                if search_term:
+                    query = query.ilike("code", f"%{search_term}%")
                 response = query.order("code").execute()
                 patients = response.data or []
                 # Agregar patient_details vacío para mantener estructura
@@ -49,43 +144,11 @@ async def list_patients(
                     detail=f"Error al consultar pacientes: {str(e2)}. Verifica que la tabla 'patients' existe y tiene RLS configurado."
                 )
         
-        # Si hay búsqueda, filtrar por código o alias
-        if search and search.strip():
-            search_term = search.strip().lower()
-            
-            # Filtrar por código o alias
-            # patient_details puede venir como array o como objeto único
-            filtered = []
-            for p in patients:
-                # Buscar en código
-                if search_term in p.get("code", "").lower():
-                    filtered.append(p)
-                    continue
-                
-                # Buscar en alias (manejar diferentes estructuras)
-                details = p.get("patient_details")
-                if details:
-                    # Si es array, tomar el primero
-                    if isinstance(details, list) and len(details) > 0:
-                        alias = details[0].get("alias", "") or ""
-                    # Si es objeto único
-                    elif isinstance(details, dict):
-                        alias = details.get("alias", "") or ""
-                    else:
-                        alias = ""
-                    
-                    if search_term in alias.lower():
-                        filtered.append(p)
-            
-            return {"patients": filtered}
-        else:
-            return {"patients": patients}
+        return {"patients": patients}
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        error_detail = f"Error al listar pacientes: {str(e)}\n{traceback.format_exc()}"
-        print(error_detail)
+        logger.exception("Error al listar pacientes: %s", e)
         raise HTTPException(status_code=500, detail=f"Error al listar pacientes: {str(e)}")
 
 @router.get("/cases")
@@ -146,6 +209,7 @@ async def list_visits(
 async def list_images(
     visit_id: str = Query(...),
     supabase: Client = Depends(get_supabase_client),
+    storage_client = Depends(get_storage_bucket),
     doctor_id: str = Depends(verify_token)
 ):
     """
@@ -161,8 +225,12 @@ async def list_images(
         
         # Obtener imágenes
         response = supabase.table("images").select("*").eq("visit_id", visit_id).eq("doctor_id", doctor_id).order("created_at", desc=True).execute()
+        images = response.data or []
         
-        return {"images": response.data or []}
+        # Signed URLs de todas las imágenes en una sola llamada a Storage
+        await _attach_signed_urls(storage_client, images)
+        
+        return {"images": images}
     except HTTPException:
         raise
     except Exception as e:
@@ -183,22 +251,18 @@ async def list_analysis(
     try:
         # Intentar obtener análisis con join a images
         try:
+            # Con visit_id se usa !inner para filtrar por la columna embebida
+            # en la misma consulta (sin buscar antes los ids de las imágenes)
+            image_embed = "images!inner" if visit_id else "images"
             query = supabase.table("analysis_results").select(
-                """
+                f"""
                 *,
-                image:images(id, storage_path, original_filename, content_type, visit_id, created_at)
+                image:{image_embed}(id, storage_path, original_filename, content_type, visit_id, created_at)
                 """
             ).eq("doctor_id", doctor_id)
             
             if visit_id:
-                # Filtrar por visit_id: primero obtener image_ids de esa visita
-                images_response = supabase.table("images").select("id").eq("visit_id", visit_id).eq("doctor_id", doctor_id).execute()
-                image_ids = [img["id"] for img in (images_response.data or [])]
-                if image_ids:
-                    query = query.in_("image_id", image_ids)
-                else:
-                    # No hay imágenes para esa visita
-                    return {"analysis": []}
+                query = query.eq("image.visit_id", visit_id)
             
             if image_id:
                 query = query.eq("image_id", image_id)
@@ -209,14 +273,14 @@ async def list_analysis(
             # Asegurar que cada análisis tenga image (puede ser null si la relación falla)
             for analysis in analyses:
                 if not analysis.get("image"):
-                    print(f"Warning: Análisis {analysis.get('id')} no tiene imagen asociada")
+                    logger.warning("Análisis %s no tiene imagen asociada", analysis.get("id"))
                     analysis["image"] = None
             
             return {"analysis": analyses}
             
         except Exception as join_error:
             # Si falla el join, intentar sin relación y luego hacer join manual
-            print(f"Warning: Error en join con images: {join_error}")
+            logger.warning("Error en join con images: %s", join_error)
             try:
                 query = supabase.table("analysis_results").select("*").eq("doctor_id", doctor_id)
                 
@@ -236,7 +300,7 @@ async def list_analysis(
                             ).eq("id", image_id_val).eq("doctor_id", doctor_id).single().execute()
                             analysis["image"] = img_response.data
                         except Exception as img_error:
-                            print(f"Warning: No se pudo cargar imagen {image_id_val}: {img_error}")
+                            logger.warning("No se pudo cargar imagen %s: %s", image_id_val, img_error)
                             analysis["image"] = None
                     else:
                         analysis["image"] = None
@@ -254,9 +318,7 @@ async def list_analysis(
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        error_detail = f"Error al listar análisis: {str(e)}\n{traceback.format_exc()}"
-        print(error_detail)
+        logger.exception("Error al listar análisis: %s", e)
         raise HTTPException(status_code=500, detail=f"Error al listar análisis: {str(e)}")
 
 @router.get("/analysis/{analysis_id}")
@@ -268,135 +330,54 @@ async def get_analysis_detail(
     """
     Obtiene un análisis específico con todos sus detalles.
     Siempre intenta incluir la imagen y su contexto completo.
+    Usa un único select anidado de PostgREST; si el embed falla de forma
+    repetida, pasa a la RPC get_analysis_with_context (join en el servidor).
     """
+    global EMBED_OK, _embed_failures
+
     try:
-        # Intentar obtener con join completo
-        try:
-            response = supabase.table("analysis_results").select(
-                """
-                *,
-                image:images(
-                    id,
-                    storage_path,
-                    original_filename,
-                    content_type,
-                    visit_id,
-                    created_at,
-                    visit:visits(
-                        id,
-                        visit_date,
-                        case:cases(
-                            id,
-                            title,
-                            patient:patients(id, code)
-                        )
-                    )
-                )
-            """
-            ).eq("id", analysis_id).eq("doctor_id", doctor_id).single().execute()
-            
-            if not response.data:
-                raise HTTPException(status_code=404, detail="Análisis no encontrado")
-            
-            analysis = response.data
-            
-            # Si la imagen no vino en el join, intentar cargarla manualmente
-            if not analysis.get("image"):
-                image_id = analysis.get("image_id")
-                if image_id:
-                    try:
-                        img_response = supabase.table("images").select(
-                            "id, storage_path, original_filename, content_type, visit_id, created_at"
-                        ).eq("id", image_id).eq("doctor_id", doctor_id).single().execute()
-                        
-                        if img_response.data:
-                            # Cargar contexto de visita y caso
-                            visit_id = img_response.data.get("visit_id")
-                            if visit_id:
-                                try:
-                                    visit_response = supabase.table("visits").select(
-                                        """
-                                        id,
-                                        visit_date,
-                                        case:cases(
-                                            id,
-                                            title,
-                                            patient:patients(id, code)
-                                        )
-                                    """
-                                    ).eq("id", visit_id).eq("doctor_id", doctor_id).single().execute()
-                                    img_response.data["visit"] = visit_response.data
-                                except Exception as visit_error:
-                                    print(f"Warning: No se pudo cargar contexto de visita: {visit_error}")
-                            
-                            analysis["image"] = img_response.data
-                        else:
-                            analysis["image"] = None
-                    except Exception as img_error:
-                        print(f"Warning: No se pudo cargar imagen {image_id}: {img_error}")
-                        analysis["image"] = None
-                else:
-                    analysis["image"] = None
-            
-            return analysis
-            
-        except HTTPException:
-            raise
-        except Exception as join_error:
-            # Si falla el join, intentar sin relación y hacer join manual
-            print(f"Warning: Error en join con images: {join_error}")
-            
-            # Obtener análisis sin relación
-            response = supabase.table("analysis_results").select("*").eq("id", analysis_id).eq("doctor_id", doctor_id).single().execute()
-            
-            if not response.data:
-                raise HTTPException(status_code=404, detail="Análisis no encontrado")
-            
-            analysis = response.data
-            image_id = analysis.get("image_id")
-            
-            # Cargar imagen manualmente
-            if image_id:
-                try:
-                    img_response = supabase.table("images").select(
-                        "id, storage_path, original_filename, content_type, visit_id, created_at"
-                    ).eq("id", image_id).eq("doctor_id", doctor_id).single().execute()
-                    
-                    if img_response.data:
-                        # Cargar contexto de visita y caso
-                        visit_id = img_response.data.get("visit_id")
-                        if visit_id:
-                            try:
-                                visit_response = supabase.table("visits").select(
-                                    """
-                                    id,
-                                    visit_date,
-                                    case:cases(
-                                        id,
-                                        title,
-                                        patient:patients(id, code)
-                                    )
-                                """
-                                ).eq("id", visit_id).eq("doctor_id", doctor_id).single().execute()
-                                img_response.data["visit"] = visit_response.data
-                            except Exception as visit_error:
-                                print(f"Warning: No se pudo cargar contexto de visita: {visit_error}")
-                        
-                        analysis["image"] = img_response.data
-                    else:
-                        analysis["image"] = None
-                except Exception as img_error:
-                    print(f"Warning: No se pudo cargar imagen {image_id}: {img_error}")
+        if EMBED_OK:
+            try:
+                response = supabase.table("analysis_results").select(
+                    ANALYSIS_DETAIL_SELECT
+                ).eq("id", analysis_id).eq("doctor_id", doctor_id).single().execute()
+                _embed_failures = 0
+
+                if not response.data:
+                    raise HTTPException(status_code=404, detail="Análisis no encontrado")
+
+                analysis = response.data
+                if not analysis.get("image"):
                     analysis["image"] = None
-            else:
-                analysis["image"] = None
-            
-            return analysis
-            
+                return analysis
+
+            except HTTPException:
+                raise
+            except Exception as join_error:
+                if _is_not_found(join_error):
+                    raise HTTPException(status_code=404, detail="Análisis no encontrado")
+                # Timeouts, 5xx, etc. no dicen nada del embed: error normal (500)
+                if not _is_embed_error(join_error):
+                    raise
+                # Relación del embed no resuelta: contar el fallo y resolver esta petición con la RPC
+                _embed_failures += 1
+                if _embed_failures >= EMBED_MAX_FAILURES:
+                    EMBED_OK = False
+                logger.warning("Error en join con images: %s", join_error)
+
+        # Una sola llamada: la función Postgres hace el join completo
+        response = supabase.rpc(
+            "get_analysis_with_context",
+            {"p_analysis_id": analysis_id, "p_doctor_id": doctor_id}
+        ).execute()
+
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Análisis no encontrado")
+
+        return response.data
+
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        error_detail = f"Error al obtener análisis: {str(e)}\n{traceback.format_exc()}"
-        print(error_detail)
+        logger.exception("Error al obtener análisis: %s", e)
         raise HTTPException(status_code=500, detail=f"Error al obtener análisis: {str(e)}")
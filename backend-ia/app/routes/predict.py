@@ -3,41 +3,248 @@ Endpoint de predicción con YOLO.
 Flujo completo:
 1. Recibe imagen + visit_id + token JWT
 2. Verifica que el visit_id pertenezca al doctor autenticado
-3. Sube imagen a Supabase Storage
+3. Sube imagen a Supabase Storage y, en paralelo,
 4. Ejecuta modelo YOLO
 5. Genera counts y detections (jsonb)
-6. Guarda en images y analysis_results
+6. Guarda en images y analysis_results (una transacción vía RPC)
 """
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
 from supabase import Client
 from typing import Optional
+import asyncio
 import uuid
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image
-import io
 import json
+import cv2
+import numpy as np
+import torch
 
-from app.config import STORAGE_BUCKET, MODEL_PATH
-from app.utils.labels import get_class_name, CLASS_NAMES
-from app.dependencies import get_supabase_client, verify_token
+from app.config import MODEL_PATH, MODEL_NAME, YOLO_WORKERS
+from app.utils.labels import translate, CLASS_NAMES_TUPLE, NUM_CLASSES
+from app.dependencies import get_supabase_client, get_storage_bucket, verify_token
 from ultralytics import YOLO
 
 router = APIRouter(prefix="/predict", tags=["predict"])
 
-# Cargar modelo YOLO una vez al iniciar
+# OpenCV solo decodifica; el paralelismo lo aporta el pool de inferencia
+cv2.setNumThreads(1)
+
+# Firmas (magic bytes) de los formatos aceptados
+JPEG_MAGIC = b"\xff\xd8\xff"
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """Retorna "JPEG" o "PNG" según los primeros bytes, o None si no coincide."""
+    if data.startswith(JPEG_MAGIC):
+        return "JPEG"
+    if data.startswith(PNG_MAGIC):
+        return "PNG"
+    return None
+
+# Plantilla de conteos (todas las clases en 0), en el orden de los índices YOLO
+_EMPTY_COUNTS = {name: 0 for name in CLASS_NAMES_TUPLE}
+
+# Tamaño máximo de imagen
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+
+# Holgura para el resto del multipart (boundaries, visit_id) sobre MAX_IMAGE_SIZE
+MAX_REQUEST_SIZE = MAX_IMAGE_SIZE + 64 * 1024
+
+def is_request_too_large(content_length: Optional[str]) -> bool:
+    """True si el Content-Length declarado ya supera el máximo permitido para /predict."""
+    try:
+        return content_length is not None and int(content_length) > MAX_REQUEST_SIZE
+    except ValueError:
+        return False
+
+async def read_upload(file: UploadFile) -> bytes:
+    """
+    Lee el archivo subido con una sola copia en memoria.
+    Starlette ya volcó el upload a un archivo temporal, así que primero se
+    rechazan los formatos distintos de JPEG/PNG (16 bytes) y los archivos de más
+    de MAX_IMAGE_SIZE, y solo entonces se lee el contenido completo.
+    """
+    head = await file.read(16)
+    if sniff_image_format(head) is None:
+        raise HTTPException(status_code=415, detail="Formato de imagen no soportado. Use JPEG o PNG")
+    if file.size is not None and file.size > MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=413, detail="Imagen demasiado grande (máximo 10MB)")
+    
+    await file.seek(0)
+    # Storage solo acepta bytes; decode y upload comparten este mismo objeto
+    data = await file.read()
+    if len(data) > MAX_IMAGE_SIZE:
+        # Versiones de Starlette sin UploadFile.size
+        raise HTTPException(status_code=413, detail="Imagen demasiado grande (máximo 10MB)")
+    return data
+
+def decode_image(data) -> Optional[np.ndarray]:
+    """Decodifica JPEG/PNG a un array HWC uint8 BGR (el formato que espera YOLO)."""
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+# Cargar el modelo YOLO una vez al iniciar: una instancia por hilo de inferencia,
+# porque los predictores de Ultralytics no son thread-safe (comparten estado y
+# las versiones recientes serializan las llamadas con un lock).
 try:
-    model = YOLO(MODEL_PATH)
-    print(f"✅ Modelo YOLO cargado desde {MODEL_PATH}")
+    _models = [YOLO(MODEL_PATH, task="detect") for _ in range(YOLO_WORKERS)]
+    model = _models[0]
+    print(f"✅ Modelo YOLO cargado desde {MODEL_PATH} ({YOLO_WORKERS} instancias)")
 except Exception as e:
     print(f"⚠️ Error al cargar modelo YOLO: {e}")
+    _models = []
     model = None
 
+_idle_models: queue.SimpleQueue = queue.SimpleQueue()
+for _m in _models:
+    _idle_models.put(_m)
+_thread_model = threading.local()
+
+def _bind_thread_model():
+    """Initializer de INFER_POOL: cada hilo toma su propia instancia del modelo."""
+    _thread_model.model = None if _idle_models.empty() else _idle_models.get_nowait()
+
+# Pool dedicado para la inferencia: el modelo se ejecuta fuera del event loop
+# y el semáforo limita cuántas peticiones esperan un hilo a la vez.
+# El semáforo se crea en start_batch_workers(): las primitivas de asyncio quedan
+# ligadas al event loop que las usa, y la app puede arrancar más de una vez.
+INFER_POOL = ThreadPoolExecutor(
+    max_workers=YOLO_WORKERS, thread_name_prefix="yolo", initializer=_bind_thread_model
+)
+_infer_semaphore: Optional[asyncio.Semaphore] = None
+
+async def run_inference(image):
+    """Ejecuta el modelo YOLO del hilo en INFER_POOL sin bloquear el event loop."""
+    loop = asyncio.get_running_loop()
+    infer = lambda: _thread_model.model(image, imgsz=640, verbose=False)
+    if _infer_semaphore is None:
+        return await loop.run_in_executor(INFER_POOL, infer)
+    async with _infer_semaphore:
+        return await loop.run_in_executor(INFER_POOL, infer)
+
+def warmup(iterations: int = 3):
+    """
+    Ejecuta el modelo sobre una imagen sintética para que la primera petición
+    real no pague la inicialización (kernels, reserva de memoria, sesión ONNX).
+    Bloqueante: llamarla desde un hilo (evento startup).
+    """
+    if not model:
+        return
+    # Repartir los núcleos entre las instancias que ejecutan en paralelo
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // YOLO_WORKERS))
+    dummy = np.zeros((640, 640, 3), dtype=np.uint8)
+    for instance in _models:
+        for _ in range(iterations):
+            instance(dummy, imgsz=640, verbose=False)
+
+# Micro-batching: las peticiones concurrentes esperan hasta BATCH_WINDOW_S
+# a otras para ejecutar el modelo una sola vez sobre un lote de hasta MAX_BATCH.
+MAX_BATCH = 8
+BATCH_WINDOW_S = 0.015
+predict_queue: Optional[asyncio.Queue] = None
+_batch_workers: list[asyncio.Task] = []
+
+async def _batch_worker(batch_queue: asyncio.Queue):
+    """Consume batch_queue, agrupa imágenes y resuelve el Future de cada una."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            # Ultralytics hace letterbox por imagen, así que los tamaños pueden diferir
+            results = await run_inference([image for image, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+def start_batch_workers():
+    """
+    Crea el semáforo y la cola en el event loop actual y arranca un worker
+    de batching por slot de inferencia (evento startup).
+    """
+    global predict_queue, _infer_semaphore
+    _infer_semaphore = asyncio.Semaphore(YOLO_WORKERS)
+    if model and not _batch_workers:
+        predict_queue = asyncio.Queue()
+        for _ in range(YOLO_WORKERS):
+            _batch_workers.append(asyncio.create_task(_batch_worker(predict_queue)))
+
+async def stop_batch_workers():
+    """Cancela los workers de batching y suelta la cola y el semáforo (evento shutdown)."""
+    global predict_queue, _infer_semaphore
+    for task in _batch_workers:
+        task.cancel()
+    await asyncio.gather(*_batch_workers, return_exceptions=True)
+    _batch_workers.clear()
+    predict_queue = None
+    _infer_semaphore = None
+
+async def predict_batched(image):
+    """Encola la imagen para el siguiente lote y retorna su resultado YOLO."""
+    # Sin workers vivos nadie consumiría la cola: inferir directamente
+    if predict_queue is None or all(task.done() for task in _batch_workers):
+        results = await run_inference(image)
+        return results[0]
+    fut = asyncio.get_running_loop().create_future()
+    await predict_queue.put((image, fut))
+    return await fut
+
+def extract_detections(result) -> tuple[dict, list]:
+    """Convierte un resultado YOLO en (counts, detections) para guardar en jsonb."""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return dict(_EMPTY_COUNTS), []
+    
+    # Un solo traspaso a NumPy por tensor en lugar de .tolist()/round() por caja.
+    # Se redondea en float64: en float32 el ruido reaparece al pasar a float de Python.
+    class_ids = boxes.cls.cpu().numpy().astype(np.int64)
+    confidences = boxes.conf.cpu().numpy().astype(np.float64).round(4).tolist()
+    coords = boxes.xyxy.cpu().numpy().astype(np.float64).round(2).tolist()
+    
+    # Conteo por clase con bincount; los ids fuera de CLASS_NAMES cuentan como "unknown"
+    bins = np.bincount(class_ids[(class_ids >= 0) & (class_ids < NUM_CLASSES)], minlength=NUM_CLASSES)
+    counts = {name: int(bins[i]) for i, name in enumerate(CLASS_NAMES_TUPLE)}
+    unknown = len(class_ids) - int(bins.sum())
+    if unknown:
+        counts["unknown"] = unknown
+    
+    detections = [
+        {
+            "class_id": class_id,
+            "class_name": class_name,
+            "confidence": confidence,
+            "bbox": {"x1": x1, "y1": y1, "x2": x2, "y2": y2}
+        }
+        for class_id, class_name, confidence, (x1, y1, x2, y2)
+        in zip(class_ids.tolist(), translate(class_ids).tolist(), confidences, coords)
+    ]
+    
+    return counts, detections
+
 @router.post("/")
 async def predict_image(
     file: UploadFile = File(...),
     visit_id: str = Form(...),
     supabase: Client = Depends(get_supabase_client),
+    storage_client = Depends(get_storage_bucket),
     doctor_id: str = Depends(verify_token)
 ):
     """
@@ -71,16 +278,13 @@ async def predict_image(
     
     # 2. Leer y validar imagen
     try:
-        image_bytes = await file.read()
-        image = Image.open(io.BytesIO(image_bytes))
+        # Lectura incremental: valida formato y tamaño sin cargar más de lo necesario
+        image_bytes = await read_upload(file)
         
-        # Validar formato
-        if image.format not in ["JPEG", "PNG"]:
-            raise HTTPException(status_code=400, detail="Formato de imagen no soportado. Use JPEG o PNG")
-        
-        # Validar tamaño (opcional: máximo 10MB)
-        if len(image_bytes) > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="Imagen demasiado grande (máximo 10MB)")
+        # Decodificar fuera del event loop
+        image = await asyncio.to_thread(decode_image, image_bytes)
+        if image is None:
+            raise HTTPException(status_code=400, detail="Error al procesar imagen: no se pudo decodificar")
         
     except HTTPException:
         raise
@@ -94,8 +298,9 @@ async def predict_image(
     storage_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}{file_extension}"
     storage_path = f"{doctor_id}/{visit_id}/{storage_filename}"
     
-    # 4. Subir imagen a Supabase Storage
-    try:
+    # 4. Subir imagen a Supabase Storage y 5. ejecutar YOLO, en paralelo:
+    # ambos solo necesitan los bytes/array de la imagen.
+    async def _upload():
         # Subir imagen usando service_role_key
         # IMPORTANTE: Las Storage policies en script.sql verifican owner = auth.uid()
         # Como usamos service_role, el owner puede no ser automáticamente el doctor_id.
@@ -107,7 +312,8 @@ async def predict_image(
         #
         # Por ahora, el código funciona pero las Storage policies pueden necesitar ajuste
         # para permitir acceso basado en la ruta además del owner.
-        upload_response = supabase.storage.from_(STORAGE_BUCKET).upload(
+        upload_response = await asyncio.to_thread(
+            storage_client.upload,
             storage_path,
             image_bytes,
             file_options={
@@ -119,91 +325,61 @@ async def predict_image(
         # Verificar que se subió correctamente
         if not upload_response:
             raise HTTPException(status_code=500, detail="Error al subir imagen a Storage")
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al subir imagen: {str(e)}")
+        return upload_response
     
-    # 5. Ejecutar modelo YOLO
-    try:
-        results = model(image)
-        result = results[0]  # Primera imagen
-        
-        # Extraer detecciones
-        detections = []
-        counts = {name: 0 for name in CLASS_NAMES.values()}
-        
-        if result.boxes is not None:
-            for box in result.boxes:
-                class_id = int(box.cls[0])
-                confidence = float(box.conf[0])
-                class_name = get_class_name(class_id)
-                
-                # Coordenadas del bounding box
-                x1, y1, x2, y2 = box.xyxy[0].tolist()
-                
-                detection = {
-                    "class_id": class_id,
-                    "class_name": class_name,
-                    "confidence": round(confidence, 4),
-                    "bbox": {
-                        "x1": round(x1, 2),
-                        "y1": round(y1, 2),
-                        "x2": round(x2, 2),
-                        "y2": round(y2, 2)
-                    }
-                }
-                detections.append(detection)
-                counts[class_name] = counts.get(class_name, 0) + 1
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al ejecutar modelo YOLO: {str(e)}")
+    async def _infer():
+        result = await predict_batched(image)
+        return extract_detections(result)
     
-    # 6. Guardar metadata de imagen en BD
-    try:
-        image_data = {
-            "doctor_id": doctor_id,
-            "visit_id": visit_id,
-            "storage_path": storage_path,
-            "original_filename": file.filename,
-            "content_type": file.content_type or "image/jpeg"
-        }
-        
-        image_response = supabase.table("images").insert(image_data).execute()
-        
-        if not image_response.data:
-            raise HTTPException(status_code=500, detail="Error al guardar metadata de imagen")
-        
-        image_id = image_response.data[0]["id"]
-        
-    except Exception as e:
-        # Si falla, intentar eliminar la imagen de Storage
+    upload_result, infer_result = await asyncio.gather(
+        _upload(), _infer(), return_exceptions=True
+    )
+    
+    if isinstance(upload_result, BaseException):
+        if isinstance(upload_result, HTTPException):
+            raise upload_result
+        raise HTTPException(status_code=500, detail=f"Error al subir imagen: {str(upload_result)}")
+    
+    if isinstance(infer_result, BaseException):
+        # La imagen ya está en Storage: intentar eliminarla
         try:
-            supabase.storage.from_(STORAGE_BUCKET).remove([storage_path])
-        except:
+            await asyncio.to_thread(storage_client.remove, [storage_path])
+        except Exception:
             pass
-        raise HTTPException(status_code=500, detail=f"Error al guardar imagen en BD: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error al ejecutar modelo YOLO: {str(infer_result)}")
     
-    # 7. Guardar resultados del análisis
+    counts, detections = infer_result
+    
+    # 6. Guardar imagen y resultados del análisis en una sola transacción (RPC)
     try:
-        analysis_data = {
-            "doctor_id": doctor_id,
-            "image_id": image_id,
-            "model_name": "best.pt",
-            "counts": counts,
-            "detections": detections
-        }
+        rpc_response = supabase.rpc("save_prediction", {
+            "p_doctor": doctor_id,
+            "p_visit": visit_id,
+            "p_path": storage_path,
+            "p_filename": file.filename,
+            "p_content_type": file.content_type or "image/jpeg",
+            "p_model": MODEL_NAME,
+            "p_counts": counts,
+            "p_detections": detections
+        }).execute()
         
-        analysis_response = supabase.table("analysis_results").insert(analysis_data).execute()
-        
-        if not analysis_response.data:
+        if not rpc_response.data:
             raise HTTPException(status_code=500, detail="Error al guardar resultados del análisis")
         
-        result_id = analysis_response.data[0]["id"]
+        image_id = rpc_response.data[0]["image_id"]
+        result_id = rpc_response.data[0]["analysis_id"]
         
     except Exception as e:
+        # Si falla no queda nada en BD; intentar eliminar la imagen de Storage
+        try:
+            await asyncio.to_thread(storage_client.remove, [storage_path])
+        except Exception:
+            pass
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=f"Error al guardar resultados: {str(e)}")
     
-    # 8. Retornar respuesta
+    # 7. Retornar respuesta
     return {
         "success": True,
         "image_id": image_id,
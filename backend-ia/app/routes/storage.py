@@ -2,17 +2,269 @@
 Endpoints para gestionar Storage (signed URLs).
 El backend genera signed URLs usando service_role_key para acceder a archivos privados.
 """
-from fastapi import APIRouter, HTTPException, Depends, Query
+import asyncio
+import hmac
+import operator
+import logging
+import re
+import time
+from typing import Any, Callable, List, Optional
+
+from cachetools import TTLCache
+from fastapi import APIRouter, HTTPException, Depends, Query, Body
+from fastapi.responses import ORJSONResponse
 from supabase import Client
-from app.dependencies import get_supabase_client, verify_token
-from app.config import STORAGE_BUCKET
+from app.dependencies import get_supabase_client, get_storage_bucket, verify_token
+from app.config import STORAGE_BUCKET, DEBUG, VALIDATE_IMAGE_IN_DB
 
 router = APIRouter(prefix="/storage", tags=["storage"])
 
-@router.get("/signed-url")
+logger = logging.getLogger(__name__)
+
+# Máximo de rutas por petición en /storage/signed-urls
+MAX_BATCH_PATHS = 100
+
+# Prefijo del bucket precalculado para normalizar storage_path
+_BUCKET_PREFIX = STORAGE_BUCKET + "/"
+_BUCKET_PREFIX_LEN = len(_BUCKET_PREFIX)
+
+# Cache de signed URLs: (doctor_id, storage_path, expires_in) -> (respuesta, expira_en).
+# TTL algo menor que la validez mínima de la URL (60 s) para no entregar URLs a punto de expirar.
+# Solo se usa desde el event loop, así que no necesita lock.
+_signed_url_cache: TTLCache = TTLCache(maxsize=4096, ttl=55)
+
+# Mensajes de Storage que indican que el archivo no existe
+_NOT_FOUND_RE = re.compile(r"not found|does not exist", re.IGNORECASE)
+
+# Cache negativo: rutas que Storage reportó como inexistentes (404) en los
+# últimos 30 s, para no repetir el round-trip ante reintentos del cliente
+_negative_cache: TTLCache = TTLCache(maxsize=2048, ttl=30)
+
+# Generaciones en curso: (doctor_id, storage_path, expires_in) -> Task que genera la respuesta
+_inflight: dict[tuple[str, str, int], asyncio.Task] = {}
+
+def _signed_url_response(result: dict, expires_at: float) -> ORJSONResponse:
+    """
+    Construye la respuesta con la validez restante de la URL y un Cache-Control
+    acorde, para que el navegador la reutilice sin volver a pedirla.
+    """
+    remaining = max(int(expires_at - time.monotonic()), 0)
+    return ORJSONResponse(
+        {**result, "expires_in": remaining},
+        headers={"Cache-Control": f"private, max-age={max(remaining - 10, 0)}"}
+    )
+
+async def _get_signed_url_single_flight(
+    supabase: Client, storage_client, doctor_id: str, storage_path: str, expires_in: int
+) -> tuple[dict, float]:
+    """
+    Genera la signed URL una sola vez por clave aunque lleguen varias peticiones
+    concurrentes: el trabajo corre en su propia tarea y todas (incluida la primera)
+    esperan su resultado. El resultado queda en _signed_url_cache.
+    """
+    cache_key = (doctor_id, storage_path, expires_in)
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(
+            _generate_and_cache_signed_url(supabase, storage_client, doctor_id, storage_path, expires_in)
+        )
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda t: _finish_inflight(cache_key, t))
+    # shield: si un solicitante se cancela no cancela el trabajo compartido
+    return await asyncio.shield(task)
+
+def _finish_inflight(cache_key: tuple[str, str, int], task: asyncio.Task) -> None:
+    """Quita la tarea de _inflight y marca su excepción como consumida aunque nadie la espere."""
+    _inflight.pop(cache_key, None)
+    if not task.cancelled():
+        task.exception()
+
+async def _generate_and_cache_signed_url(
+    supabase: Client, storage_client, doctor_id: str, storage_path: str, expires_in: int
+) -> tuple[dict, float]:
+    """Tarea compartida del single-flight: genera la URL y la guarda en _signed_url_cache."""
+    result = await _generate_signed_url(supabase, storage_client, doctor_id, storage_path, expires_in)
+    entry = (result, time.monotonic() + expires_in)
+    _signed_url_cache[(doctor_id, storage_path, expires_in)] = entry
+    return entry
+
+def _detect_url_extractor(response) -> Callable[[Any], Optional[str]]:
+    """
+    Determina cómo leer la URL de la respuesta de create_signed_url.
+    La forma depende de la versión de supabase-py y no cambia durante la vida
+    del proceso, así que se detecta una vez y se reutiliza.
+    """
+    if isinstance(response, str):
+        return lambda r: r
+    if isinstance(response, dict):
+        # Puede ser {"signedURL": "..."} o {"signed_url": "..."} o {"url": "..."}
+        for key in ("signedURL", "signed_url", "url"):
+            if response.get(key):
+                return operator.itemgetter(key)
+    for attr in ("signedURL", "signed_url"):
+        if getattr(response, attr, None):
+            return operator.attrgetter(attr)
+    # Forma desconocida: no volver a fijar un extractor hasta ver una válida
+    return _detect_and_extract
+
+def _detect_and_extract(response) -> Optional[str]:
+    """Extractor inicial: detecta la forma de la respuesta y fija _extract_url."""
+    global _extract_url
+    extractor = _detect_url_extractor(response)
+    if extractor is _detect_and_extract:
+        return None
+    _extract_url = extractor
+    return extractor(response)
+
+_extract_url: Callable[[Any], Optional[str]] = _detect_and_extract
+
+def _handle_storage_error(exc: Exception, storage_path: str) -> HTTPException:
+    """Traduce un error de Storage a 404 (archivo inexistente) o 500."""
+    error_msg = str(exc)
+    logger.warning("Error al generar signed URL para '%s': %s", storage_path, error_msg, exc_info=exc if DEBUG else None)
+    
+    # Verificar si el error es porque el archivo no existe
+    if _NOT_FOUND_RE.search(error_msg):
+        return HTTPException(
+            status_code=404,
+            detail=f"Archivo no encontrado en Storage: {storage_path}"
+        )
+    
+    return HTTPException(
+        status_code=500,
+        detail=f"Error al generar URL firmada: {error_msg}"
+    )
+
+def _create_signed_url(storage_client, storage_path: str, expires_in: int):
+    """Llama a create_signed_url (bloqueante) tolerando versiones sin expires_in."""
+    try:
+        return storage_client.create_signed_url(storage_path, expires_in)
+    except TypeError:
+        # Si falla, intentar sin el parámetro de expiración
+        return storage_client.create_signed_url(storage_path)
+
+async def _generate_signed_url(
+    supabase: Client, storage_client, doctor_id: str, storage_path: str, expires_in: int
+) -> dict:
+    """Genera la signed URL de storage_path con Storage como única fuente de verdad."""
+    # Generar signed URL usando service_role_key (permite acceso a archivos privados).
+    # storage_client es el cliente del bucket creado al arrancar la app.
+    # En Supabase Python, create_signed_url puede tener diferentes sintaxis
+    # Intentar con la sintaxis estándar: create_signed_url(path, expires_in)
+    
+    # Por defecto solo se llama a Storage: la propiedad ya se validó por la ruta
+    # (doctor_id/...) y las policies del bucket; si el archivo no existe,
+    # Storage responde "not found" y se traduce a 404.
+    # Las llamadas del cliente síncrono se ejecutan en hilos para no bloquear el event loop.
+    sign = asyncio.to_thread(_create_signed_url, storage_client, storage_path, expires_in)
+    if VALIDATE_IMAGE_IN_DB:
+        # Verificación en BD en paralelo con la firma
+        image_check, signed_url_response = await asyncio.gather(
+            asyncio.to_thread(
+                supabase.table("images").select("id").eq("storage_path", storage_path).eq("doctor_id", doctor_id).limit(1).execute
+            ),
+            sign,
+            return_exceptions=True
+        )
+    else:
+        image_check = None
+        try:
+            signed_url_response = await sign
+        except Exception as storage_error:
+            signed_url_response = storage_error
+    
+    if isinstance(signed_url_response, Exception):
+        http_error = _handle_storage_error(signed_url_response, storage_path)
+        if http_error.status_code == 404:
+            _negative_cache[(doctor_id, storage_path)] = True
+        raise http_error
+    
+    if VALIDATE_IMAGE_IN_DB:
+        if isinstance(image_check, Exception):
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error al verificar imagen en BD: {str(image_check)}"
+            )
+        if not image_check.data:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Imagen no encontrada en BD: {storage_path}"
+            )
+    
+    # Procesar la respuesta con el extractor detectado en la primera llamada;
+    # si la forma cambiara, volver a detectarla
+    try:
+        signed_url = _extract_url(signed_url_response)
+    except (KeyError, AttributeError, TypeError):
+        signed_url = _detect_and_extract(signed_url_response)
+    
+    if not signed_url:
+        logger.error("Respuesta inesperada de create_signed_url: %r (tipo: %s)", signed_url_response, type(signed_url_response))
+        raise HTTPException(
+            status_code=500,
+            detail="No se pudo generar la URL firmada. El archivo puede no existir en Storage."
+        )
+    
+    return {
+        "signed_url": signed_url,
+        "expires_in": expires_in,
+        "storage_path": storage_path
+    }
+
+def _validate_storage_path(storage_path: str, doctor_id: str) -> str:
+    """
+    Normaliza storage_path (sin bucket) y verifica que pertenezca al doctor.
+    Lanza HTTPException 400/403; no hace llamadas a Supabase.
+    """
+    # Validar que storage_path no incluya el bucket
+    if storage_path.startswith(_BUCKET_PREFIX):
+        storage_path = storage_path[_BUCKET_PREFIX_LEN:]
+    
+    # Validar que el archivo pertenezca al doctor
+    # Extraer doctor_id de la ruta: formato esperado "{doctor_id}/{visit_id}/{filename}"
+    # split con maxsplit=2: solo se separan los dos primeros segmentos
+    path_parts = storage_path.split("/", 2)
+    if not (len(path_parts) == 3 and path_parts[0] and path_parts[1] and path_parts[2]):
+        raise HTTPException(
+            status_code=400,
+            detail="Formato de ruta inválido. Debe ser: doctor_id/visit_id/filename"
+        )
+    
+    # Verificar que el doctor_id en la ruta coincida con el autenticado,
+    # antes de cualquier llamada a Supabase. Comparación en tiempo constante
+    # (en bytes: compare_digest no acepta str con caracteres no ASCII)
+    if not hmac.compare_digest(path_parts[0].encode(), doctor_id.encode()):
+        raise HTTPException(
+            status_code=403,
+            detail="No tienes permiso para acceder a este archivo"
+        )
+    
+    return storage_path
+
+async def _get_signed_url_entry(
+    supabase: Client, storage_client, doctor_id: str, storage_path: str, expires_in: int
+) -> tuple[dict, float]:
+    """Retorna (respuesta, expira_en) desde los caches o generándola (single-flight)."""
+    # Si la URL se generó hace poco, reutilizarla sin llamar a Supabase
+    cached = _signed_url_cache.get((doctor_id, storage_path, expires_in))
+    if cached:
+        return cached
+    
+    # Archivo que Storage reportó como inexistente hace poco
+    if (doctor_id, storage_path) in _negative_cache:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Archivo no encontrado en Storage: {storage_path}"
+        )
+    
+    return await _get_signed_url_single_flight(supabase, storage_client, doctor_id, storage_path, expires_in)
+
+@router.get("/signed-url", response_class=ORJSONResponse)
 async def get_signed_url(
     storage_path: str = Query(..., description="Ruta del archivo en Storage (sin bucket)"),
+    expires_in: int = Query(60, ge=60, le=3600, description="Validez de la URL en segundos"),
     supabase: Client = Depends(get_supabase_client),
+    storage_client = Depends(get_storage_bucket),
     doctor_id: str = Depends(verify_token)
 ):
     """
@@ -21,107 +273,48 @@ async def get_signed_url(
     Args:
         storage_path: Ruta del archivo (ej: "doctor_id/visit_id/filename.jpg")
                      NO debe incluir el nombre del bucket
+        expires_in: Validez de la URL en segundos (60-3600)
     
     Returns:
-        signed_url: URL firmada válida por 60 segundos
+        signed_url: URL firmada; expires_in indica los segundos de validez restantes
     """
-    try:
-        # Validar que storage_path no incluya el bucket
-        if storage_path.startswith(STORAGE_BUCKET + "/"):
-            storage_path = storage_path[len(STORAGE_BUCKET) + 1:]
-        
-        # Validar que el archivo pertenezca al doctor (verificar en BD)
-        # Extraer doctor_id de la ruta: formato esperado "{doctor_id}/{visit_id}/{filename}"
-        path_parts = storage_path.split("/")
-        if len(path_parts) < 3:
-            raise HTTPException(
-                status_code=400,
-                detail="Formato de ruta inválido. Debe ser: doctor_id/visit_id/filename"
-            )
-        
-        path_doctor_id = path_parts[0]
-        
-        # Verificar que el doctor_id en la ruta coincida con el autenticado
-        if path_doctor_id != doctor_id:
-            raise HTTPException(
-                status_code=403,
-                detail="No tienes permiso para acceder a este archivo"
-            )
-        
-        # Verificar que la imagen existe en la BD y pertenece al doctor
-        # Buscar por storage_path en la tabla images
-        image_check = supabase.table("images").select("id").eq("storage_path", storage_path).eq("doctor_id", doctor_id).limit(1).execute()
-        
-        if not image_check.data:
-            # No es crítico, puede que la imagen no esté en BD pero sí en Storage
-            # Continuar con la generación de URL
-            print(f"Warning: Imagen con storage_path '{storage_path}' no encontrada en BD, pero generando URL de todas formas")
-        
-        # Generar signed URL usando service_role_key (permite acceso a archivos privados)
-        try:
-            # En Supabase Python, create_signed_url puede tener diferentes sintaxis
-            # Intentar con la sintaxis estándar: create_signed_url(path, expires_in)
-            storage_client = supabase.storage.from_(STORAGE_BUCKET)
-            
-            # El método create_signed_url puede retornar un dict o la URL directamente
-            try:
-                signed_url_response = storage_client.create_signed_url(storage_path, 60)
-            except TypeError:
-                # Si falla, intentar sin el parámetro de expiración
-                signed_url_response = storage_client.create_signed_url(storage_path)
-            
-            # Procesar la respuesta
-            signed_url = None
-            if isinstance(signed_url_response, str):
-                signed_url = signed_url_response
-            elif isinstance(signed_url_response, dict):
-                # Puede ser {"signedURL": "..."} o {"signed_url": "..."} o {"url": "..."}
-                signed_url = (
-                    signed_url_response.get("signedURL") or 
-                    signed_url_response.get("signed_url") or 
-                    signed_url_response.get("url")
-                )
-            elif hasattr(signed_url_response, 'signedURL'):
-                signed_url = signed_url_response.signedURL
-            elif hasattr(signed_url_response, 'signed_url'):
-                signed_url = signed_url_response.signed_url
-            
-            if not signed_url:
-                print(f"Debug: Respuesta de create_signed_url: {signed_url_response} (tipo: {type(signed_url_response)})")
-                raise HTTPException(
-                    status_code=500,
-                    detail="No se pudo generar la URL firmada. El archivo puede no existir en Storage."
-                )
-            
-            return {
-                "signed_url": signed_url,
-                "expires_in": 60,
-                "storage_path": storage_path
-            }
-            
-        except Exception as storage_error:
-            error_msg = str(storage_error)
-            print(f"Error al generar signed URL para '{storage_path}': {error_msg}")
-            
-            # Verificar si el error es porque el archivo no existe
-            if "not found" in error_msg.lower() or "does not exist" in error_msg.lower():
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"Archivo no encontrado en Storage: {storage_path}"
-                )
-            
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error al generar URL firmada: {error_msg}"
-            )
-            
-    except HTTPException:
-        raise
-    except Exception as e:
-        import traceback
-        error_detail = f"Error al generar signed URL: {str(e)}\n{traceback.format_exc()}"
-        print(error_detail)
+    storage_path = _validate_storage_path(storage_path, doctor_id)
+    # Se retorna la respuesta ya construida: evita jsonable_encoder sobre el dict
+    return _signed_url_response(*await _get_signed_url_entry(supabase, storage_client, doctor_id, storage_path, expires_in))
+
+@router.post("/signed-urls", response_class=ORJSONResponse)
+async def get_signed_urls(
+    storage_paths: List[str] = Body(..., description="Rutas de archivos en Storage (sin bucket)"),
+    expires_in: int = Query(60, ge=60, le=3600, description="Validez de las URLs en segundos"),
+    supabase: Client = Depends(get_supabase_client),
+    storage_client = Depends(get_storage_bucket),
+    doctor_id: str = Depends(verify_token)
+):
+    """
+    Genera signed URLs para varias rutas en una sola petición (galerías).
+    Cada ruta se valida y firma por separado, en paralelo; un error en una
+    ruta no afecta a las demás.
+    
+    Args:
+        storage_paths: Lista JSON de rutas (máximo MAX_BATCH_PATHS)
+        expires_in: Validez de las URLs en segundos (60-3600)
+    
+    Returns:
+        signed_urls: Un objeto por ruta, en el mismo orden, con signed_url o error
+    """
+    if len(storage_paths) > MAX_BATCH_PATHS:
         raise HTTPException(
-            status_code=500,
-            detail=f"Error al generar signed URL: {str(e)}"
+            status_code=400,
+            detail=f"Demasiadas rutas (máximo {MAX_BATCH_PATHS})"
         )
+    
+    async def _sign(path: str) -> dict:
+        try:
+            storage_path = _validate_storage_path(path, doctor_id)
+            result, expires_at = await _get_signed_url_entry(supabase, storage_client, doctor_id, storage_path, expires_in)
+            return {**result, "expires_in": max(int(expires_at - time.monotonic()), 0)}
+        except HTTPException as e:
+            return {"storage_path": path, "error": e.detail, "status_code": e.status_code}
+    
+    results = await asyncio.gather(*(_sign(path) for path in storage_paths))
+    return ORJSONResponse({"signed_urls": results})
@@ -3,6 +3,7 @@ Mapeo de clases YOLO a nombres médicos estandarizados.
 El modelo YOLO retorna índices numéricos (0-8), este módulo los traduce
 a nombres médicos reconocibles para el análisis de sedimento urinario.
 """
+import numpy as np
 
 # Mapeo: índice YOLO -> nombre médico en español/inglés
 CLASS_NAMES = {
@@ -26,10 +27,29 @@ CLASS_NAMES_ES = {
     6: "Levadura",
 }
 
+# Los índices son un rango denso 0..N-1: como tuplas, la búsqueda es un acceso
+# directo por índice. Los dicts de arriba se mantienen por compatibilidad.
+CLASS_NAMES_TUPLE = tuple(CLASS_NAMES[i] for i in range(len(CLASS_NAMES)))
+CLASS_NAMES_ES_TUPLE = tuple(CLASS_NAMES_ES[i] for i in range(len(CLASS_NAMES_ES)))
+NUM_CLASSES = len(CLASS_NAMES_TUPLE)
+
 def get_class_name(class_id: int) -> str:
     """Retorna el nombre médico en inglés para un índice de clase."""
-    return CLASS_NAMES.get(class_id, "unknown")
+    return CLASS_NAMES_TUPLE[class_id] if 0 <= class_id < NUM_CLASSES else "unknown"
 
 def get_class_name_es(class_id: int) -> str:
     """Retorna el nombre médico en español para un índice de clase."""
-    return CLASS_NAMES_ES.get(class_id, "Desconocido")
+    return CLASS_NAMES_ES_TUPLE[class_id] if 0 <= class_id < NUM_CLASSES else "Desconocido"
+
+
+# Tabla para traducir arrays de índices en bloque; la última posición es "unknown"
+_LABELS_EN = np.array(CLASS_NAMES_TUPLE + ("unknown",), dtype=object)
+
+def translate(class_ids) -> np.ndarray:
+    """
+    Traduce un array de índices de clase a nombres en inglés en una sola
+    operación vectorizada. Índices fuera de rango se traducen a "unknown".
+    """
+    ids = np.asarray(class_ids, dtype=np.int64)
+    ids = np.where((ids >= 0) & (ids < NUM_CLASSES), ids, NUM_CLASSES)
+    return _LABELS_EN[ids]
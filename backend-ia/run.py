@@ -0,0 +1,24 @@
+"""
+Punto de entrada único del backend.
+
+Uso (desde backend-ia/):
+    python run.py
+Usa uvloop + httptools y WORKERS procesos (por defecto 1). Cada worker carga
+su propia copia del modelo YOLO, así que dimensionar según la RAM disponible.
+
+Alternativa con Gunicorn:
+    gunicorn -k uvicorn.workers.UvicornWorker -w $(nproc) app.main:app
+"""
+import os
+
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "1")),
+    )
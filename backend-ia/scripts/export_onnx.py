@@ -0,0 +1,122 @@
+"""
+Exporta app/model/best.pt a ONNX (app/model/best.onnx) para inferencia con ONNX Runtime.
+Al existir best.onnx, app/config.py lo selecciona automáticamente como MODEL_PATH.
+
+Uso (desde backend-ia/):
+    python scripts/export_onnx.py              # FP32, funciona en cualquier CPU
+    python scripts/export_onnx.py --half       # FP16 (requiere GPU CUDA al exportar)
+    python scripts/export_onnx.py --int8 --calib calib_images/
+                                               # INT8 estático con ONNX Runtime (~200 imágenes)
+"""
+import argparse
+import glob
+import os
+import shutil
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+MODEL_DIR = os.path.join(os.path.dirname(__file__), "..", "app", "model")
+IMGSZ = 640
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def letterbox(image: np.ndarray, size: int = IMGSZ) -> np.ndarray:
+    """Redimensiona manteniendo la proporción y rellena con gris (114), como Ultralytics."""
+    h, w = image.shape[:2]
+    scale = min(size / h, size / w)
+    new_h, new_w = round(h * scale), round(w * scale)
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+    top, left = (size - new_h) // 2, (size - new_w) // 2
+    canvas[top:top + new_h, left:left + new_w] = resized
+    return canvas
+
+def quantize_int8(fp32_path: str, int8_path: str, calib_dir: str, calib_size: int):
+    """Cuantización estática INT8 (QDQ) calibrada con imágenes reales del dominio."""
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    )
+
+    paths = sorted(
+        p for p in glob.glob(os.path.join(calib_dir, "*"))
+        if p.lower().endswith(IMAGE_EXTENSIONS)
+    )[:calib_size]
+    if not paths:
+        raise SystemExit(f"No hay imágenes de calibración en {calib_dir}")
+
+    fp32_model = onnx.load(fp32_path)
+    input_name = fp32_model.graph.input[0].name
+
+    class ImageReader(CalibrationDataReader):
+        """Entrega las imágenes con el mismo preprocesado que la inferencia (RGB, /255, NCHW)."""
+        def __init__(self):
+            self._paths = iter(paths)
+
+        def get_next(self):
+            for path in self._paths:
+                image = cv2.imread(path)
+                if image is None:
+                    continue
+                rgb = cv2.cvtColor(letterbox(image), cv2.COLOR_BGR2RGB)
+                tensor = rgb.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+                return {input_name: tensor}
+            return None
+
+    quantize_static(
+        fp32_path,
+        int8_path,
+        ImageReader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        weight_type=QuantType.QInt8,
+        activation_type=QuantType.QUInt8,
+    )
+
+    # Ultralytics lee nombres de clases, stride e imgsz de los metadatos del ONNX
+    int8_model = onnx.load(int8_path)
+    if not int8_model.metadata_props:
+        int8_model.metadata_props.extend(fp32_model.metadata_props)
+        onnx.save(int8_model, int8_path)
+    print(f"Cuantizado a INT8 con {len(paths)} imágenes de calibración")
+
+def main():
+    parser = argparse.ArgumentParser(description="Exportar best.pt a ONNX")
+    parser.add_argument("--half", action="store_true", help="Exportar en FP16 (requiere CUDA)")
+    parser.add_argument("--int8", action="store_true", help="Cuantización INT8 estática con ONNX Runtime")
+    parser.add_argument("--calib", help="Carpeta con imágenes de calibración (requerida con --int8)")
+    parser.add_argument("--calib-size", type=int, default=200, help="Máximo de imágenes de calibración")
+    args = parser.parse_args()
+
+    if args.int8 and not args.calib:
+        parser.error("--int8 requiere --calib con la carpeta de imágenes de calibración")
+    if args.int8 and args.half:
+        parser.error("--int8 y --half son excluyentes")
+
+    # Ultralytics no cuantiza a INT8 en formato ONNX: se exporta en FP32
+    # y se cuantiza después con onnxruntime.quantization
+    model = YOLO(os.path.join(MODEL_DIR, "best.pt"))
+    exported = model.export(
+        format="onnx",
+        imgsz=IMGSZ,
+        dynamic=True,
+        simplify=True,
+        half=args.half,
+        device=0 if args.half else "cpu",
+    )
+
+    target = os.path.join(MODEL_DIR, "best.onnx")
+    if args.int8:
+        # El export FP32 suele quedar en la misma ruta que target: cuantizar a un temporal
+        int8_path = os.path.join(MODEL_DIR, "best.int8.onnx")
+        quantize_int8(exported, int8_path, args.calib, args.calib_size)
+        os.replace(int8_path, target)
+        if os.path.abspath(exported) != os.path.abspath(target):
+            os.remove(exported)
+    elif os.path.abspath(exported) != os.path.abspath(target):
+        shutil.move(exported, target)
+    print(f"✅ Modelo exportado a {target}")
+
+if __name__ == "__main__":
+    main()
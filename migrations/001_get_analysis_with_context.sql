@@ -0,0 +1,46 @@
+-- Detalle de un análisis con todo su contexto en una sola consulta.
+-- Usado por GET /history/analysis/{analysis_id} cuando el embed de PostgREST
+-- no está disponible. Retorna la misma forma que el select anidado:
+-- analysis_results.* + image { ..., visit { ..., case { ..., patient } } }
+
+create or replace function public.get_analysis_with_context(
+    p_analysis_id uuid,
+    p_doctor_id uuid
+)
+returns jsonb
+language sql
+stable
+security invoker
+as $$
+    select to_jsonb(a) || jsonb_build_object(
+        'image', case when i.id is null then null else jsonb_build_object(
+            'id', i.id,
+            'storage_path', i.storage_path,
+            'original_filename', i.original_filename,
+            'content_type', i.content_type,
+            'visit_id', i.visit_id,
+            'created_at', i.created_at,
+            'visit', case when v.id is null then null else jsonb_build_object(
+                'id', v.id,
+                'visit_date', v.visit_date,
+                'case', case when c.id is null then null else jsonb_build_object(
+                    'id', c.id,
+                    'title', c.title,
+                    'patient', case when p.id is null then null else jsonb_build_object(
+                        'id', p.id,
+                        'code', p.code
+                    ) end
+                ) end
+            ) end
+        ) end
+    )
+    from public.analysis_results a
+    left join public.images i on i.id = a.image_id and i.doctor_id = a.doctor_id
+    left join public.visits v on v.id = i.visit_id and v.doctor_id = a.doctor_id
+    left join public.cases c on c.id = v.case_id and c.doctor_id = a.doctor_id
+    left join public.patients p on p.id = c.patient_id and p.doctor_id = a.doctor_id
+    where a.id = p_analysis_id
+      and a.doctor_id = p_doctor_id;
+$$;
+
+grant execute on function public.get_analysis_with_context(uuid, uuid) to authenticated, service_role;
@@ -0,0 +1,10 @@
+-- Índices trigram para la búsqueda por código/alias de GET /history/patients
+-- (filtros ilike '%term%' resueltos en el servidor).
+
+create extension if not exists pg_trgm;
+
+create index if not exists patients_code_trgm
+    on public.patients using gin (code gin_trgm_ops);
+
+create index if not exists patient_details_alias_trgm
+    on public.patient_details using gin (alias gin_trgm_ops);
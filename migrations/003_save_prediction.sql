@@ -0,0 +1,37 @@
+-- Guarda la imagen y su resultado de análisis en una sola transacción.
+-- Usado por POST /predict/: una llamada en lugar de dos inserts encadenados,
+-- y sin filas huérfanas en images si falla el insert del análisis.
+
+create or replace function public.save_prediction(
+    p_doctor uuid,
+    p_visit uuid,
+    p_path text,
+    p_filename text,
+    p_content_type text,
+    p_model text,
+    p_counts jsonb,
+    p_detections jsonb
+)
+returns table (image_id uuid, analysis_id uuid)
+language plpgsql
+security invoker
+as $$
+#variable_conflict use_column
+declare
+    v_image uuid;
+    v_analysis uuid;
+begin
+    insert into public.images (doctor_id, visit_id, storage_path, original_filename, content_type)
+    values (p_doctor, p_visit, p_path, p_filename, p_content_type)
+    returning id into v_image;
+
+    insert into public.analysis_results (doctor_id, image_id, model_name, counts, detections)
+    values (p_doctor, v_image, p_model, p_counts, p_detections)
+    returning id into v_analysis;
+
+    return query select v_image, v_analysis;
+end;
+$$;
+
+grant execute on function public.save_prediction(uuid, uuid, text, text, text, text, jsonb, jsonb)
+    to authenticated, service_role;
@@ -0,0 +1,43 @@
+-- Índices compuestos para los filtros más frecuentes del backend
+-- (doctor_id + columna secundaria, ordenados como en las consultas de /history).
+
+create index if not exists images_doctor_visit_idx
+    on public.images (doctor_id, visit_id, created_at desc);
+
+create index if not exists analysis_doctor_image_idx
+    on public.analysis_results (doctor_id, image_id, created_at desc);
+
+create index if not exists visits_doctor_case_idx
+    on public.visits (doctor_id, case_id, visit_date desc);
+
+create index if not exists cases_doctor_patient_idx
+    on public.cases (doctor_id, patient_id, created_at desc);
+
+-- Políticas RLS: envolver auth.uid() en un subselect para que Postgres lo
+-- evalúe una sola vez por consulta (initPlan) y no una vez por fila.
+-- Se reescriben todas las políticas del esquema public que aún lo llaman directo.
+do $$
+declare
+    pol record;
+    v_sql text;
+begin
+    for pol in
+        select schemaname, tablename, policyname, qual, with_check
+        from pg_policies
+        where schemaname = 'public'
+          and (
+              (qual like '%auth.uid()%' and qual not ilike '%select auth.uid()%')
+              or (with_check like '%auth.uid()%' and with_check not ilike '%select auth.uid()%')
+          )
+    loop
+        v_sql := format('alter policy %I on %I.%I', pol.policyname, pol.schemaname, pol.tablename);
+        if pol.qual is not null then
+            v_sql := v_sql || format(' using (%s)', replace(pol.qual, 'auth.uid()', '(select auth.uid())'));
+        end if;
+        if pol.with_check is not null then
+            v_sql := v_sql || format(' with check (%s)', replace(pol.with_check, 'auth.uid()', '(select auth.uid())'));
+        end if;
+        execute v_sql;
+    end loop;
+end;
+$$;